@@ -16,9 +16,10 @@ See Also:
 """
 
 import argparse
-import json
+import threading
 from time import sleep
 
+import orjson
 import paho.mqtt.client as mqtt
 
 # parse command line arguments
@@ -26,10 +27,17 @@ argparser = argparse.ArgumentParser()
 argparser.add_argument("--host", type=str, help="MQTT broker host")
 argparser.add_argument("--port", type=int, help="MQTT broker port")
 argparser.add_argument("--access-token", type=str, help="Device access token")
+argparser.add_argument(
+    "--debug",
+    action="store_true",
+    help="Log paho internals and print messages of unhandled topics",
+)
 args = argparser.parse_args()
 
 # defaults
 desired_attributes = ["test1", "test2", "test3"]
+# callbacks run in paho's network thread -> guard access from the main thread
+desired_attributes_lock = threading.Lock()
 
 
 # The callback for when the client receives a CONNACK response from the server.
@@ -41,12 +49,25 @@ def on_connect(client, userdata, flags, reason_code, properties):  # noqa: ANN00
     client.subscribe("v1/devices/me/attributes/response/+")
 
 
-# The callback for when a PUBLISH message is received from the server.
+# The callback for when a PUBLISH message is received from the server
+# (and no topic specific callback below matches).
 def on_message(client, userdata, msg):  # noqa: ANN001, ANN201, ARG001, D103
+    if args.debug:
+        print("<<< " + msg.topic + " " + str(msg.payload))
+
+
+# The callback for shared attribute updates.
+def on_shared_update(client, userdata, msg):  # noqa: ANN001, ANN201, ARG001, D103
+    print("<<< " + msg.topic + " " + str(msg.payload))
+
+
+# The callback for responses to attribute requests.
+def on_response(client, userdata, msg):  # noqa: ANN001, ANN201, ARG001, D103
     global desired_attributes  # noqa: PLW0603
     print("<<< " + msg.topic + " " + str(msg.payload))
-    if msg.topic.startswith("v1/devices/me/attributes/response/"):
-        desired_attributes = json.loads(msg.payload)["shared"]
+    shared = orjson.loads(msg.payload)["shared"]
+    with desired_attributes_lock:
+        desired_attributes = shared
 
 
 def publish(client: mqtt.Client, topic: str, msg: str) -> None:  # noqa: D103
@@ -55,9 +76,13 @@ def publish(client: mqtt.Client, topic: str, msg: str) -> None:  # noqa: D103
 
 
 mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-mqttc.enable_logger()
+if args.debug:
+    mqttc.enable_logger()  # costly for high message rates
 mqttc.on_connect = on_connect
 mqttc.on_message = on_message
+# dispatch per topic filter (paho matches topics with a topic tree)
+mqttc.message_callback_add("v1/devices/me/attributes", on_shared_update)
+mqttc.message_callback_add("v1/devices/me/attributes/response/+", on_response)
 mqttc.username_pw_set(args.access_token)
 
 # simulate box
@@ -78,7 +103,8 @@ sleep(2)
 print()
 
 print("--- startup: request box attributes ---")
-keys = ",".join(desired_attributes)
+with desired_attributes_lock:
+    keys = ",".join(desired_attributes)  # joined once, reused for the request
 publish(mqttc, "v1/devices/me/attributes/request/1", '{"sharedKeys": "' + keys + '"}')
 
 sleep(2)
@@ -1,8 +1,10 @@
 """Connect to ThingsBoard with MQTTS as device and use custom RPCs."""
 
 import argparse
-import json
+import base64
+import gzip
 
+import orjson
 import paho.mqtt.client as mqtt
 
 # parse command line arguments
@@ -13,8 +15,22 @@ argparser.add_argument("--access-token", type=str, help="Device access token")
 argparser.add_argument(
     "--rpc",
     type=str,
+    action="append",
     choices=["getJobs", "checkoutJobs", "abortJobs", "uploadMeasurements"],
-    help="RPC to call",
+    help="RPC to call (repeat to publish several RPCs in a burst)",
+)
+argparser.add_argument(
+    "--qos",
+    type=int,
+    choices=[0, 1],
+    default=0,
+    help="MQTT QoS of the RPC requests",
+)
+argparser.add_argument(
+    "--compress",
+    action="store_true",
+    help="Send uploadMeasurements jobs gzip compressed and base64 encoded "
+    "(params.encoding = 'gzip+b64', the server has to decode it)",
 )
 args = argparser.parse_args()
 
@@ -43,6 +59,8 @@ def on_message(client, userdata, msg):  # noqa: ANN001, ANN201, ARG001, D103
 mqttc = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
 mqttc.on_connect = on_connect
 mqttc.on_message = on_message
+# don't throttle bursts of (QoS 1) requests waiting for their PUBACKs
+mqttc.max_inflight_messages_set(65535)
 
 # basic auth (with access token)
 mqttc.tls_set()
@@ -52,38 +70,42 @@ mqttc.connect(args.host, args.port, 60)
 
 
 # simulate some RPCs
-
-if args.rpc == "getJobs":
-    mqttc.publish("v1/devices/me/rpc/request/1", '{"method": "getJobs", "params": {}}')
-    print("Requested getJobs RPC")
-
-if args.rpc == "checkoutJobs":
-    mqttc.publish(
-        "v1/devices/me/rpc/request/1",
-        '{"method": "checkoutJobs", "params": {"ids": ["iwr_Sammelauftrag_59139"]}}',
-    )
-    print("Requested checkoutJobs RPC")
-
-if args.rpc == "abortJobs":
-    mqttc.publish(
-        "v1/devices/me/rpc/request/1",
-        '{"method": "abortJobs", "params": {"ids": ["iwr_Sammelauftrag_59128"]}}',
-    )
-    print("Requested abortJobs RPC")
-
-if args.rpc == "uploadMeasurements":
-    with open("job.json") as f:  # noqa: PTH123
-        job = f.read()
-    rpc = {
-        "method": "uploadMeasurements",
-        "params": {
-            "jobs": {"iwr_Sammelauftrag_59139": job},
-        },
-    }
-    mqttc.publish("v1/devices/me/rpc/request/1", json.dumps(rpc))
-    print("Requested uploadMeasurements RPC")
-
-if args.rpc is None:
+# all requests are published before the network loop runs, i.e., they are
+# pipelined instead of waiting for each to be sent/acknowledged
+
+payload: str | bytes
+for request_id, rpc in enumerate(args.rpc or [], start=1):
+    if rpc == "getJobs":
+        payload = '{"method": "getJobs", "params": {}}'
+
+    if rpc == "checkoutJobs":
+        payload = (
+            '{"method": "checkoutJobs", "params": {"ids": ["iwr_Sammelauftrag_59139"]}}'
+        )
+
+    if rpc == "abortJobs":
+        payload = (
+            '{"method": "abortJobs", "params": {"ids": ["iwr_Sammelauftrag_59128"]}}'
+        )
+
+    if rpc == "uploadMeasurements":
+        with open("job.json", "rb") as f:  # noqa: PTH123
+            job = f.read()
+        params: dict[str, object] = {}
+        if args.compress:
+            # jobs are verbose JSON -> shrink the bytes on the wire
+            job_b64 = base64.b64encode(gzip.compress(job)).decode()
+            params["jobs"] = {"iwr_Sammelauftrag_59139": job_b64}
+            params["encoding"] = "gzip+b64"
+        else:
+            # the job as JSON string (same data as the decoded compressed job)
+            params["jobs"] = {"iwr_Sammelauftrag_59139": job.decode()}
+        payload = orjson.dumps({"method": "uploadMeasurements", "params": params})
+
+    mqttc.publish(f"v1/devices/me/rpc/request/{request_id}", payload, qos=args.qos)
+    print(f"Requested {rpc} RPC")
+
+if not args.rpc:
     print("No RPC requested, just connecting to see incoming messages")
 
 
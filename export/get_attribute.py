@@ -17,12 +17,17 @@ sensitive information such as username and password !!!
 """
 
 import argparse
+import csv
 import logging
+from typing import Any
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
 from tb_rest_client.rest_client_pe import (
     RestClientPE,
 )
+from urllib3.util import Retry
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
@@ -31,23 +36,28 @@ logging.basicConfig(
 )
 
 
-def get_attribute(
+def get_attributes(
     client: RestClientPE,
     match_attribute_key: str,
-    match_attribute_value: str,
+    match_attribute_values: list[str],
     get_attribute_key: str,
-) -> str:
-    """Query an attribute given another's value per device.
+) -> dict[str, str]:
+    """Query an attribute given another's value for many devices at once.
 
-    Searches for devices where `match_attribute_key == match_attribute_value`
-    and returns the value of `get_attribute_key` attribute for that device.
+    Searches for devices where `match_attribute_key` is in `match_attribute_values`
+    and returns the value of `get_attribute_key` attribute per matched value.
 
-    Uses the entities query API of ThingsBoard.
+    Uses the entities query API of ThingsBoard with a single `IN` key filter
+    (paged, if the server returns less than requested).
 
-    Limitations: Works only for match_attribute_value of type STRING.
+    Limitations: Works only for match_attribute_values of type STRING
+    not containing a comma (TB splits the `IN` value by comma).
     Adapt the query if you need other types.
     """
-    query = {
+    if not match_attribute_values:
+        return {}
+
+    query: dict[str, Any] = {
         "entityFilter": {
             "type": "entityType",
             "resolveMultiple": True,
@@ -65,41 +75,56 @@ def get_attribute(
                 "key": {"type": "ATTRIBUTE", "key": match_attribute_key},
                 "valueType": "STRING",
                 "predicate": {
-                    "operation": "EQUAL",
+                    "operation": "IN",
                     "value": {
-                        "defaultValue": match_attribute_value,
+                        "defaultValue": ",".join(match_attribute_values),
                         "dynamicValue": None,
                     },
                     "type": "STRING",
                 },
             },
         ],
-        "pageLink": {"page": 0, "pageSize": 2},
+        "pageLink": {"page": 0, "pageSize": len(match_attribute_values)},
     }
-    logger.debug("Querying device: %s", query)
+    logger.debug("Querying devices: %s", query)
 
-    res = client.entity_query_controller.find_entity_data_by_query_using_post(
-        body=query,
-    )
-    if len(res.data) != 1:
+    attributes: dict[str, str] = {}
+    while True:
+        res = client.entity_query_controller.find_entity_data_by_query_using_post(
+            body=query,
+        )
+        for d in res.data:
+            match_attribute_value = d.latest["ATTRIBUTE"][match_attribute_key].value
+            if match_attribute_value in attributes:
+                msg = (
+                    f"Expected exactly one device with {match_attribute_key} "
+                    + match_attribute_value
+                    + ", found multiple"
+                )
+                raise ValueError(msg)
+            logger.debug("Found device %s: %s", d.entity_id.id, d.latest["ATTRIBUTE"])
+            attributes[match_attribute_value] = d.latest["ATTRIBUTE"][
+                get_attribute_key
+            ].value
+            logger.debug(
+                "%s -> %s",
+                match_attribute_value,
+                attributes[match_attribute_value],
+            )
+        if not res.has_next:
+            break
+        query["pageLink"]["page"] += 1
+
+    missing = set(match_attribute_values) - attributes.keys()
+    if len(missing) > 0:
         msg = (
             f"Expected exactly one device with {match_attribute_key} "
-            + match_attribute_value
-            + f", found {len(res.data)}"
+            + ", ".join(sorted(missing))
+            + ", found none"
         )
         raise ValueError(msg)
 
-    logger.debug(
-        "Found device %s: %s",
-        res.data[0].entity_id.id,
-        res.data[0].latest["ATTRIBUTE"],
-    )
-    logger.debug(
-        "%s -> %s",
-        match_attribute_value,
-        res.data[0].latest["ATTRIBUTE"][get_attribute_key].value,
-    )
-    return res.data[0].latest["ATTRIBUTE"][get_attribute_key].value
+    return attributes
 
 
 if __name__ == "__main__":
@@ -153,8 +178,28 @@ if __name__ == "__main__":
     logger.info("Connecting to ThingsBoard %s as user %s", args.host, args.username)
     tb.login(args.username, args.password)
 
-    # read csv file
-    df = pd.read_csv(args.csv)
+    # retry transient server errors (the entity query only reads data)
+    # applies to the connection pool of the host created on the first request
+    tb.api_client.rest_client.pool_manager.connection_pool_kw["retries"] = Retry(
+        total=3,
+        backoff_factor=0.2,
+        status_forcelist=[502, 503, 504],
+        allowed_methods=None,
+    )
+
+    # read csv file (multi-threaded parser, arrow-backed columns)
+    # all columns as strings -> values are written back unchanged
+    # (pandas' pyarrow engine would infer types first, e.g., reformat timestamps)
+    # header without a BOM as pyarrow strips it (e.g., Excel's "CSV UTF-8")
+    with open(args.csv, newline="", encoding="utf-8-sig") as f:  # noqa: PTH123
+        header = next(csv.reader(f))
+    df = pacsv.read_csv(
+        args.csv,
+        convert_options=pacsv.ConvertOptions(
+            column_types=dict.fromkeys(header, pa.string()),
+            strings_can_be_null=True,
+        ),
+    ).to_pandas(types_mapper=pd.ArrowDtype)
 
     # first column is the attribute to match on
     match_attribute_key = df.columns[0]
@@ -165,15 +210,15 @@ if __name__ == "__main__":
     logger.info("Loaded %d rows from CSV file.", len(df))
     logger.debug("Dataframe:\n%s", df)
 
-    # get attribute for each row
-    df[args.attribute] = df[match_attribute_key].apply(
-        lambda row: get_attribute(
-            tb,
-            match_attribute_key,
-            str(row),
-            args.attribute,
-        ),
+    # get attribute for all rows with a single (paged) query
+    match_attribute_values = df[match_attribute_key].astype(str)
+    attributes = get_attributes(
+        tb,
+        match_attribute_key,
+        match_attribute_values.unique().tolist(),
+        args.attribute,
     )
+    df[args.attribute] = match_attribute_values.map(attributes)
     logger.info("Enriched dataframe with attribute '%s'.", args.attribute)
     logger.debug("Enriched Dataframe:\n%s", df)
 
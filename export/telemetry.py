@@ -1,6 +1,7 @@
 """Script to get telemetry of a specific device or all devices of a profile.
 
-Exports the telemetry data in the specified output format (csv or parquet).
+Exports the telemetry data in the specified output format (csv or parquet)
+with the timestamps `ts` in UTC.
 Additionally creates a metadata.json file with device and attribute information.
 
 Example usage (get the token from ThingsBoard UI / account / security):
@@ -25,24 +26,51 @@ Check the number of data points per device and time range.
 Adapt the time window size in the code if you get too many data points
 for a single request (default is 24 hours with max 1000 points).
 Maximum number of devices in a profile is 1000 (adapt if needed).
+Telemetry requests are sent concurrently (default max. 16 in parallel).
+Each window is appended to the output file in order, so memory is bounded by
+the windows ahead of the writer (default max. 32), not by the time range.
+
+Exported devices are tracked in a checkpoint file (hidden, in the working
+directory, named by the arguments affecting the output). If a run is
+interrupted, rerun it with the same arguments to skip the devices already
+exported (without `--end-time`, the end time of the interrupted run is used).
+The checkpoint is removed after a complete run.
 """
 
 import argparse
-import json
+import hashlib
 import sys
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import UTC, datetime, timedelta
-from typing import Any
+from itertools import islice
+from pathlib import Path
+from typing import TextIO
 
+import orjson
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 from loguru import logger
-from tb_rest_client.models.models_ce.entity_id import EntityId
 from tb_rest_client.rest_client_ce import RestClientCE
+from urllib3.util import Retry
 
 # --- constants ---
 
 device_limit = 1000  # max number of devices to query per profile
 points_limit = 1000  # max number of telemetry points to query per request
 batch_window = timedelta(hours=24)  # time window per request
+max_workers = 16  # max number of concurrent requests
+max_pending = 2 * max_workers  # max number of requests ahead of the writer
+pool_maxsize = 2 * max_workers  # max number of kept-alive connections
+# retry transient server errors (all requests of this script only read data)
+retries = Retry(
+    total=3,
+    backoff_factor=0.2,
+    status_forcelist=[502, 503, 504],
+    allowed_methods=None,
+)
 
 # --- helpers ---
 
@@ -61,9 +89,105 @@ def device_query(profile_name: str) -> dict:
     }
 
 
-def ts_to_datetime(ts: int) -> datetime:
-    """Convert milliseconds since epoch to datetime."""
-    return datetime.fromtimestamp(ts / 1000, tz=UTC)
+def time_windows(start_ms: int, end_ms: int) -> list[tuple[int, int]]:
+    """Split a time range into request windows (milliseconds since epoch)."""
+    window_ms = int(batch_window.total_seconds() * 1000)
+    return [
+        (ts, min(ts + window_ms, end_ms)) for ts in range(start_ms, end_ms, window_ms)
+    ]
+
+
+def checkpoint_id(args: argparse.Namespace) -> str:
+    """Identify a run by the arguments affecting its output."""
+    output_args = {
+        key: getattr(args, key)
+        for key in (
+            "host",
+            "device_id",
+            "device_profile",
+            "start_time",
+            "end_time",
+            "keys",
+            "output_format",
+        )
+    }
+    return hashlib.sha256(orjson.dumps(output_args)).hexdigest()[:12]
+
+
+def load_checkpoint(path: str) -> dict:
+    """Load the state of an interrupted run (end time and exported devices)."""
+    try:
+        with open(path, "rb") as f:  # noqa: PTH123
+            return orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}
+
+
+def save_checkpoint(path: str, checkpoint: dict) -> None:
+    """Save the state of a run atomically (no partial file on a crash)."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:  # noqa: PTH123
+        f.write(orjson.dumps(checkpoint))
+    Path(tmp).replace(path)
+
+
+class TelemetryWriter:
+    """Append the telemetry of a device window by window to a csv or parquet file.
+
+    The file is created with the first window written,
+    i.e., no file is created for a device without telemetry.
+    """
+
+    def __init__(self, output_file: str, output_format: str, keys: list[str]) -> None:
+        """Initialize writer for the given keys (columns besides `ts`)."""
+        self.output_format = output_format
+        self.path = output_file + (
+            ".csv" if output_format == "csv" else ".snappy.parquet"
+        )
+        self.keys = keys
+        self.size = 0  # number of rows written
+        # TB returns values as strings (unless strict data types are requested)
+        self._schema = pa.schema(
+            [
+                ("ts", pa.timestamp("ms", tz="UTC")),
+                *((key, pa.string()) for key in keys),
+            ],
+        )
+        self._csv: TextIO | None = None
+        self._parquet: pq.ParquetWriter | None = None
+
+    def write(self, df: pd.DataFrame) -> None:
+        """Append a window of telemetry (keys missing in this window are empty)."""
+        df = df.reindex(columns=["ts", *self.keys])
+        if self.output_format == "csv":
+            if self._csv is None:
+                self._csv = open(self.path, "w", newline="")  # noqa: PTH123, SIM115
+            # fixed timestamp format (pandas would pick one per window otherwise)
+            df.to_csv(
+                self._csv,
+                header=self.size == 0,
+                index=False,
+                date_format="%Y-%m-%dT%H:%M:%S.%f%z",
+            )
+        else:
+            if self._parquet is None:
+                self._parquet = pq.ParquetWriter(
+                    self.path,
+                    self._schema,
+                    compression="snappy",
+                )
+            df = df.astype(dict.fromkeys(self.keys, "string"))
+            self._parquet.write_table(
+                pa.Table.from_pandas(df, schema=self._schema, preserve_index=False),
+            )
+        self.size += len(df)
+
+    def close(self) -> None:
+        """Close the output file (if any was created)."""
+        if self._csv is not None:
+            self._csv.close()
+        if self._parquet is not None:
+            self._parquet.close()
 
 
 # --- main ---
@@ -109,8 +233,7 @@ if __name__ == "__main__":
     argparser.add_argument(
         "--end-time",
         type=str,
-        help="End time for telemetry data (ISO format)",
-        default=datetime.now(UTC).isoformat(),
+        help="End time for telemetry data (ISO format, default: now)",
     )
     argparser.add_argument(
         "--keys",
@@ -125,6 +248,7 @@ if __name__ == "__main__":
         help="Enable debug logging",
     )
     args = argparser.parse_args()
+    wanted_keys = frozenset(args.keys.split(",")) if args.keys else None
     logger.trace(f"Arguments: {args}")  # note this logs sensitive info!
     if not args.verbose:
         logger.remove()
@@ -136,8 +260,15 @@ if __name__ == "__main__":
     )
     logger.info(f"Connecting to ThingsBoard {args.host}")
     token = args.token.removeprefix("Bearer ").strip()
+    # keep-alive connections for all concurrent requests (incl. metadata),
+    # the rest client's pool manager is created on login
+    tb.configuration.connection_pool_maxsize = pool_maxsize
     tb.token_login(token)
 
+    # retry transient server errors (the export only reads data)
+    # applies to the connection pool of the host created on the first request
+    tb.api_client.rest_client.pool_manager.connection_pool_kw["retries"] = retries
+
     # get all devices of the profile
     device_ids: list[str] = []
     if args.device_profile:
@@ -156,119 +287,193 @@ if __name__ == "__main__":
         logger.error("Either --device-profile or --device-id must be specified")
         sys.exit(1)
 
+    # devices exported by a previous (interrupted) run with the same arguments
+    # (a device is checkpointed once its file is complete, e.g., parquet footer)
+    # (named by the hash only, profile names may contain e.g. slashes)
+    checkpoint_file = f".telemetry_{checkpoint_id(args)}.ckpt"
+    checkpoint = load_checkpoint(checkpoint_file)
+    # end time defaults to now (or to the end time of the interrupted run)
+    args.end_time = (
+        args.end_time or checkpoint.get("end_time") or datetime.now(UTC).isoformat()
+    )
+    checkpoint["end_time"] = args.end_time
+    exported: dict[str, dict | None] = checkpoint.setdefault("devices", {})
+    if len(exported) > 0:
+        logger.info(f"Resume from {checkpoint_file}: skip {len(exported)} devices")
+
+    dt_start = datetime.fromisoformat(args.start_time)
+    dt_end = datetime.fromisoformat(args.end_time)
+    windows = time_windows(
+        int(dt_start.timestamp() * 1000),
+        int(dt_end.timestamp() * 1000),
+    )
+
     # collect device data
-    all_meta: list[dict] = []
-    for device_id in device_ids:
-        meta = {
-            "host": args.host,
-            "device_id": device_id,
-            "start_time": args.start_time,
-            "end_time": args.end_time,
-            "telemetry": {},
-        }
-        if args.device_profile:
-            meta["device_profile"] = args.device_profile
-
-        # --- attributes ---
-        logger.debug(f"Get attributes for device {device_id}...")
-
-        attribute_keys = tb.get_attribute_keys(EntityId(device_id, "DEVICE"))
-        logger.debug(f"Attribute keys: {attribute_keys}")
-
-        res = tb.get_attributes(EntityId(device_id, "DEVICE"), ",".join(attribute_keys))
-        meta["attributes"] = {a["key"]: a["value"] for a in res}
-        logger.trace(f"Attributes for device {device_id}: {meta['attributes']}")
-
-        # --- telemetry ---
-        logger.debug(f"Get telemetry for device {device_id}...")
-
-        telemetry_keys = tb.telemetry_controller.get_timeseries_keys_using_get1(
-            async_req=False,
-            entity_type="DEVICE",
-            entity_id=device_id,
-        )
-        logger.debug(f"Telemetry keys: {telemetry_keys}")
-        meta["telemetry"]["keys"] = telemetry_keys
-        if args.keys:
-            telemetry_keys = [
-                key for key in telemetry_keys if key in args.keys.split(",")
-            ]
-            logger.debug(f"Filtered telemetry keys: {telemetry_keys}")
-        meta["telemetry"]["exported_keys"] = telemetry_keys
-
-        dt_start = datetime.fromisoformat(args.start_time)
-        dt_end = datetime.fromisoformat(args.end_time)
-        dt_current = dt_start
-
-        df = pd.DataFrame(columns=["ts", *telemetry_keys])
-        while dt_current < dt_end:
-            # specify time window in milliseconds since epoch
-            ts = int(dt_current.timestamp() * 1000)
-            te = int(min(dt_current + batch_window, dt_end).timestamp() * 1000)
-
-            logger.debug(f"Device {device_id}, keys {telemetry_keys} from {ts} to {te}")
-            res = tb.telemetry_controller.get_timeseries_using_get(
-                async_req=False,
+    # requests are I/O bound -> issue them concurrently and write in order,
+    # with at most `max_pending` requests ahead of the writer (bounded memory)
+    get_timeseries = tb.telemetry_controller.get_timeseries_using_get
+
+    def telemetry_requests(
+        executor: ThreadPoolExecutor,
+    ) -> Iterator[tuple[dict, tuple[int, int, Future[dict]] | None]]:
+        """Yield (metadata, (ts, te, request)) per device and window.
+
+        A request is submitted when its item is pulled.
+        Each device ends with an item without request.
+        """
+        for device_id in device_ids:
+            if device_id in exported:
+                logger.debug(f"Device {device_id} already exported")
+                continue
+
+            meta = {
+                "host": args.host,
+                "device_id": device_id,
+                "start_time": args.start_time,
+                "end_time": args.end_time,
+                "telemetry": {},
+            }
+            if args.device_profile:
+                meta["device_profile"] = args.device_profile
+
+            # --- metadata ---
+            # independent requests -> send in parallel (async_req returns a handle)
+            logger.debug(f"Get attribute and telemetry keys for device {device_id}...")
+
+            attribute_keys_req = tb.telemetry_controller.get_attribute_keys_using_get(
+                async_req=True,
+                entity_type="DEVICE",
+                entity_id=device_id,
+            )
+            telemetry_keys_req = tb.telemetry_controller.get_timeseries_keys_using_get1(
+                async_req=True,
+                entity_type="DEVICE",
+                entity_id=device_id,
+            )
+
+            # --- attributes ---
+            attribute_keys = attribute_keys_req.get()
+            logger.debug(f"Attribute keys: {attribute_keys}")
+
+            attributes_req = tb.telemetry_controller.get_attributes_using_get(
+                async_req=True,
                 entity_type="DEVICE",
                 entity_id=device_id,
-                keys=",".join(telemetry_keys),
-                start_ts=ts,
-                end_ts=te,
-                limit=points_limit,
+                keys=",".join(attribute_keys),
             )
+
+            # --- telemetry ---
+            logger.debug(f"Get telemetry for device {device_id}...")
+
+            telemetry_keys = telemetry_keys_req.get()
+            logger.debug(f"Telemetry keys: {telemetry_keys}")
+            meta["telemetry"]["keys"] = telemetry_keys
+            if wanted_keys is not None:
+                telemetry_keys = [key for key in telemetry_keys if key in wanted_keys]
+                logger.debug(f"Filtered telemetry keys: {telemetry_keys}")
+            meta["telemetry"]["exported_keys"] = telemetry_keys
+
+            keys = ",".join(telemetry_keys)
+            for ts, te in windows:
+                logger.debug(f"Device {device_id}, keys {keys} from {ts} to {te}")
+                request = executor.submit(
+                    get_timeseries,
+                    async_req=False,
+                    entity_type="DEVICE",
+                    entity_id=device_id,
+                    keys=keys,
+                    start_ts=ts,
+                    end_ts=te,
+                    limit=points_limit,
+                )
+                yield meta, (ts, te, request)
+
+            # telemetry requests are in flight -> wait for the attributes
+            meta["attributes"] = {a["key"]: a["value"] for a in attributes_req.get()}
+            logger.trace(f"Attributes for device {device_id}: {meta['attributes']}")
+            yield meta, None
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    writer: TelemetryWriter | None = None
+    try:
+        requests = telemetry_requests(executor)
+        pending = deque(islice(requests, max_pending))
+        while pending:
+            meta, item = pending.popleft()
+            pending.extend(islice(requests, 1))  # keep the executor busy
+            device_id = meta["device_id"]
+            output_file = f"{dt_start.date()}_{dt_end.date()}_{device_id}"
+            if writer is None:
+                writer = TelemetryWriter(
+                    output_file,
+                    args.output_format,
+                    meta["telemetry"]["exported_keys"],
+                )
+
+            if item is None:
+                # all windows of the device written
+                writer.close()
+                if writer.size == 0:
+                    logger.warning(f"No telemetry data for device {device_id}")
+                    exported[device_id] = None
+                else:
+                    logger.info(
+                        f"Saved telemetry of device {device_id} to {output_file}",
+                    )
+                    meta["telemetry"]["file"] = output_file
+                    meta["telemetry"]["size"] = writer.size
+                    exported[device_id] = meta
+                save_checkpoint(checkpoint_file, checkpoint)
+                writer = None
+                continue
+
+            ts, te, request = item
+            res = request.result()
             logger.trace(res)
 
-            # collect values per timestamp
+            # long (ts, key, value) rows -> wide frame with one column per key
             # {"key": [{"ts": 123456789, "value": 123}, ...], ...}
-            records: dict[int, dict[str, Any]] = {}
-            for key, samples in res.items():
-                for sample in samples:
-                    ts = sample["ts"]
-                    value = sample["value"]
-                    row = records.setdefault(ts, {"ts": ts})
-                    row[key] = value
-
-            # append to dataframe
-            if len(records) > 0:
-                df_part = pd.DataFrame.from_records(list(records.values()))
-                df = pd.concat([df, df_part], ignore_index=True)
-
-            # increment time window
-            dt_current += batch_window
-
-        if len(df) == 0:
-            logger.warning(f"No telemetry data for device {device_id}")
-            continue
-
-        df = df.sort_values("ts")
-        logger.debug(f"Telemetry for {device_id} from {dt_start} to {dt_end}\n{df}")
-
-        # save to file
-        output_file = f"{dt_start.date()}_{dt_end.date()}_{device_id}"
-        if args.output_format == "csv":
-            df.to_csv(output_file + ".csv", index=False)
-        elif args.output_format == "parquet":
-            df.to_parquet(
-                output_file + ".snappy.parquet",
-                compression="snappy",
-                index=False,
+            rows = [
+                (sample["ts"], key, sample["value"])
+                for key, samples in res.items()
+                for sample in samples
+            ]
+            if len(rows) == 0:
+                continue
+
+            # write window by window in time order (pivot sorts a window by ts)
+            df_part = (
+                pd.DataFrame(rows, columns=["ts", "key", "value"])  # noqa: PD010
+                .pivot(index="ts", columns="key", values="value")
+                .rename_axis(columns=None)
+                .reset_index()
             )
-        logger.info(f"Saved telemetry data for device {device_id} to {output_file}")
-        meta["telemetry"]["file"] = output_file
-        meta["telemetry"]["size"] = len(df)
-
-        all_meta.append(meta)
+            # milliseconds since epoch -> UTC timestamps (vectorized)
+            df_part["ts"] = pd.to_datetime(df_part["ts"], unit="ms", utc=True)
+            logger.debug(f"Telemetry for {device_id} from {ts} to {te}")
+            logger.trace(f"\n{df_part}")
+            writer.write(df_part)
+    except BaseException:
+        # e.g., error response or Ctrl+C -> don't send the queued requests
+        executor.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        if writer is not None:
+            writer.close()
+    executor.shutdown()
+
+    all_meta = [meta for meta in exported.values() if meta is not None]
 
     # save metadata
     meta_file = "metadata.json"
     try:
         # if file exists, append the new metadata
-        with open(meta_file) as f:  # noqa: PTH123
+        with open(meta_file, "rb") as f:  # noqa: PTH123
             try:
-                existing_meta = json.load(f)
+                existing_meta = orjson.loads(f.read())
                 all_meta = existing_meta + all_meta
                 logger.debug("Append to existing metadata")
-            except json.JSONDecodeError:
+            except orjson.JSONDecodeError:
                 meta_file = datetime.now(UTC).strftime(
                     "metadata_%Y-%m-%dT%H:%M:%S.json",
                 )
@@ -277,6 +482,9 @@ if __name__ == "__main__":
     except FileNotFoundError:
         # file does not exist, create a new one -> continue below
         pass
-    with open(meta_file, "w") as f:  # noqa: PTH123
-        json.dump(all_meta, f, indent=2)
+    with open(meta_file, "wb") as f:  # noqa: PTH123
+        f.write(orjson.dumps(all_meta, option=orjson.OPT_INDENT_2))
     logger.info(f"Saved metadata to {meta_file}")
+
+    # complete -> a rerun shall export again
+    Path(checkpoint_file).unlink(missing_ok=True)